@@ -1,8 +1,13 @@
-from typing import Type, Sequence, Union
+from typing import List, Optional, Tuple, Sequence, Union
 
 from multiprocessing import Pool
+from concurrent.futures import ThreadPoolExecutor
 
+import asyncio
 import datetime
+import itertools
+import threading
+import time
 
 import os
 import pathlib
@@ -12,7 +17,15 @@ import shutil
 import csv
 import json
 
+import tqdm
+
+import aiohttp
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
 import secedgar as sec
+from secedgar.client import NetworkClient
 from secedgar.parser import MetaParser
 from secedgar.exceptions import EDGARQueryError, NoFilingsError
 
@@ -27,18 +40,108 @@ COMPANY_CSV = DATA_DIR / "meta" / "largest_mining_companies_by_market_cap_with_f
 COMPANY_COL = "symbol"
 
 
+class SessionClient(NetworkClient):
+    """EDGAR client reusing one keep-alive HTTP session for all queries
+
+    The stock ``NetworkClient`` opens a new ``requests.Session`` (thus a new
+    TCP + TLS connection) for every query, i.e., each CIK lookup and each
+    page of the filing index.
+    """
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._session = None
+        self._lock = threading.Lock()
+        self._last_query = 0.
+
+    def __getstate__(self) -> dict:
+        """Sessions (and locks) do not survive pickling; workers open their own if needed"""
+
+        state = self.__dict__.copy()
+        state['_session'] = None
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    @property
+    def session(self) -> requests.Session:
+        """Lazily created session with the same retry policy as the stock client"""
+
+        if self._session is None:
+            retry = Retry(self.retry_count, backoff_factor=self.backoff_factor, raise_on_status=True)
+
+            self._session = requests.Session()
+            self._session.headers.update({"User-Agent": self.user_agent})
+            self._session.mount(self._BASE, adapter=HTTPAdapter(max_retries=retry))
+            self._session.hooks["response"].append(self._validate_response)
+        return self._session
+
+    def get_response(self, path, params=None, **kwargs) -> requests.Response:
+
+        # Queries may be issued from several threads at once; space them out
+        #   to stay within the rate limit (downloads are throttled separately)
+        with self._lock:
+            time.sleep(max(0, self._last_query + 1 / self.rate_limit - time.monotonic()))
+            self._last_query = time.monotonic()
+            session = self.session
+        return session.get(self._prepare_query(path), params=params, **kwargs)
+
+    async def download_async(self, inputs: Sequence[Tuple[str, str]]) -> List[Optional[BaseException]]:
+        """Download (url, path) pairs, at most ``rate_limit`` per second over one connection pool
+
+        Unlike ``wait_for_download_async``, a failed download does not abort the
+        others; the exception (``None`` if succeeded) is returned for each pair.
+        """
+
+        async def fetch_and_save(link: str, path: str, session: aiohttp.ClientSession) -> None:
+            contents = await self.fetch(link, session)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as f:
+                f.write(contents)
+
+        conn = aiohttp.TCPConnector(limit=self.rate_limit)
+        headers = {"Connection": "keep-alive", "User-Agent": self.user_agent}
+
+        errors = []
+        async with aiohttp.ClientSession(connector=conn, headers=headers, raise_for_status=True) as session:
+            for i in tqdm.tqdm(range(0, len(inputs), self.rate_limit)):
+                start = time.monotonic()
+                errors.extend(await asyncio.gather(*[fetch_and_save(link, path, session)
+                                                     for link, path in inputs[i:i + self.rate_limit]],
+                                                   return_exceptions=True))
+
+                # SEC EDGAR allows (up to) 10 requests per second
+                await asyncio.sleep(max(0, 1 - (time.monotonic() - start)))
+        return errors
+
+    def close(self) -> None:
+        if self._session is not None:
+            self._session.close()
+            self._session = None
+
+
 class Fetcher:
 
-    def __init__(self, 
+    def __init__(self,
                  save_dir: str, 
                  user_agent: str, 
-                 filing_type: Type[sec.FilingType],
+                 filing_types: Union[sec.FilingType, Sequence[sec.FilingType]],
                  start_date: datetime.date = None) -> None:
-        self.save_dir    = save_dir
-        self.user_agent  = user_agent
-        self.filing_type = filing_type
-        self.parser      = MetaParser()
-        self.start_date  = start_date or datetime.date(2005, 12, 31)
+        if isinstance(filing_types, sec.FilingType):
+            filing_types = [filing_types]
+        filing_types = list(filing_types)
+        if not filing_types:
+            raise ValueError("At least one filing type must be given")
+
+        self.save_dir     = save_dir
+        self.user_agent   = user_agent
+        self.filing_types = filing_types
+        self.parser       = MetaParser()
+        self.client       = SessionClient(user_agent)
+        self.start_date   = start_date or datetime.date(2005, 12, 31)
 
     def process(self, ciks: Union[str, Sequence[str]]):
         """Simple wrapper for batched processing of cik(s)"""
@@ -46,37 +149,77 @@ class Fetcher:
         if isinstance(ciks, str):
             ciks = [ciks]
 
-        print(f"[ INFO ] :: {self.filing_type.value} Fetcher processing {len(ciks)} CIKs...")
-        results = [self._fetch_single(cik) for cik in ciks]
+        try:
+            filing_types = '/'.join(t.value for t in self.filing_types)
+            print(f"[ INFO ] :: {filing_types} Fetcher processing {len(ciks)} CIKs...")
+
+            # Look up all filing types of a CIK concurrently
+            with ThreadPoolExecutor(len(self.filing_types)) as executor:
+                futures = [executor.submit(self._query_single, cik, filing_type)
+                            for cik, filing_type in itertools.product(ciks, self.filing_types)]
+                queries = [future.result() for future in futures]
 
-        n_failed = 0
-        for _, status, msg in results:
-            n_failed += int(not status)
-            print(msg)
-        print(f"[ INFO ] :: {len(results) - n_failed} / {len(results)} processed successfully.")
+            # Download filings of all CIKs as one rate-limited batch
+            inputs = [link for *_, links in queries for link in links]
+            errors = dict(zip((path for _, path in inputs), asyncio.run(self.client.download_async(inputs))))
 
-    def _fetch_single(self, cik: str) -> bool:
-        """Driver methods to retrieve filings for a single company (cik)"""
+            # Share one worker pool across all CIKs
+            results = []
+            with Pool(max(os.cpu_count() - 1, 1)) as pool:
+                for cik, filing_type, status, msg, links in queries:
+                    if status:
+                        cik, status, msg = self._extract_single(cik, filing_type, [errors[path] for _, path in links], pool)
+                    results.append((cik, status, msg))
+
+            n_failed = 0
+            for _, status, msg in results:
+                n_failed += int(not status)
+                print(msg)
+            print(f"[ INFO ] :: {len(results) - n_failed} / {len(results)} processed successfully.")
+        finally:
+            self.client.close()
+
+    def _query_single(self,
+                      cik: str,
+                      filing_type: sec.FilingType) -> Tuple[str, sec.FilingType, bool, str, List[Tuple[str, str]]]:
+        """Look up filings for a single company (cik), return (url, path) pairs to download"""
 
         cik = cik.lower().strip()
 
-        dout = os.path.join(self.save_dir, cik, self.filing_type.value)
+        dout = os.path.join(self.save_dir, cik, filing_type.value)
         if os.path.exists(dout):
             shutil.rmtree(dout)
 
         try:
-            filings = sec.filings(cik, self.filing_type, self.user_agent, self.start_date)
-            filings.save(self.save_dir)
-
-            with Pool(os.cpu_count() - 1) as p:
-                p.map(self._parse_single, glob.glob(os.path.join(dout, '*.txt')))
-            return cik, True, f"[  OK  ] :: Fetched {self.filing_type.value} for {cik}"
+            filings = sec.filings(cik, filing_type, self.user_agent, self.start_date, client=self.client)
+            links = [(url, os.path.join(dout, filings.get_accession_number(url)))
+                        for urls in filings.get_urls_safely().values() for url in urls]
+            return cik, filing_type, True, "", links
         except EDGARQueryError:
-            return cik, False, f"[ FAIL ] :: Unknown CIK: {cik}" 
+            return cik, filing_type, False, f"[ FAIL ] :: Unknown CIK: {cik}", []
         except NoFilingsError:
-            return cik, False, f"[ FAIL ] :: No {self.filing_type.value} found for CIK {cik}"
+            return cik, filing_type, False, f"[ FAIL ] :: No {filing_type.value} found for CIK {cik}", []
+        except Exception as e:
+            return cik, filing_type, False, (f"[ FAIL ] :: Unknown error when retrieving {filing_type.value} for {cik}; "
+                                                 f"See error message: {e}"), []
+
+    def _extract_single(self,
+                        cik: str,
+                        filing_type: sec.FilingType,
+                        errors: Sequence[Optional[BaseException]],
+                        pool: Pool) -> Tuple[str, bool, str]:
+        """Driver methods to parse downloaded filings for a single company (cik)"""
+
+        dout = os.path.join(self.save_dir, cik, filing_type.value)
+        try:
+            for e in errors:
+                if e is not None:
+                    raise e
+
+            pool.map(self._parse_single, glob.glob(os.path.join(dout, '*.txt')))
+            return cik, True, f"[  OK  ] :: Fetched {filing_type.value} for {cik}"
         except Exception as e:
-            return cik, False, (f"[ FAIL ] :: Unknown error when retrieving {self.filing_type.value} for {cik}; "
+            return cik, False, (f"[ FAIL ] :: Unknown error when retrieving {filing_type.value} for {cik}; "
                                     f"See error message: {e}")
 
     def _parse_single(self, fpath: str):
@@ -85,14 +228,16 @@ class Fetcher:
         dout = os.path.splitext(fpath)[0]
         self.parser.process(fpath)
 
-        # Move source file to out-dir
-        shutil.move(fpath, os.path.join(dout, '__RAW__.htm'))
-        shutil.move(os.path.join(dout, '0.metadata.json'), os.path.join(dout, '__META__.json'))
-
-        # Rename according to metadata
-        with open(os.path.join(dout, '__META__.json')) as f:
+        # Read metadata before moving anything around
+        with open(os.path.join(dout, '0.metadata.json')) as f:
             metadata = json.load(f)
 
+        # Move source file to out-dir; all within the same directory tree so
+        #   a plain (atomic) rename suffices
+        os.replace(fpath, os.path.join(dout, '__RAW__.htm'))
+        os.replace(os.path.join(dout, '0.metadata.json'), os.path.join(dout, '__META__.json'))
+
+        # Rename according to metadata
         droot = pathlib.Path(dout).parent
         os.rename(dout, droot / metadata['FILED_AS_OF_DATE'])
 
@@ -103,11 +248,10 @@ if __name__ == '__main__':
     with open(COMPANY_CSV) as f:
         ciks = [row[COMPANY_COL] for row in csv.DictReader(f)]
 
-    # Fetch filings
-    fetcher_10k = Fetcher(SAVE_DIR, USER_AGENT.format(random.randint(0, 255)), sec.FilingType.FILING_10K)
-    fetcher_20f = Fetcher(SAVE_DIR, USER_AGENT.format(random.randint(0, 255)), sec.FilingType.FILING_20F)
-    fetcher_40f = Fetcher(SAVE_DIR, USER_AGENT.format(random.randint(0, 255)), sec.FilingType.FILING_40F)
-
-    # fetcher_10k.process(ciks)
-    fetcher_20f.process(ciks)
-    fetcher_40f.process(ciks)
+    # Fetch filings of all types
+    fetcher = Fetcher(SAVE_DIR, USER_AGENT.format(random.randint(0, 255)), [
+        # sec.FilingType.FILING_10K,
+        sec.FilingType.FILING_20F,
+        sec.FilingType.FILING_40F,
+    ])
+    fetcher.process(ciks)
@@ -1,16 +1,20 @@
 #!/usr/bin/env python3
 # %%
 import os
-import glob
+import mmap
+import itertools
 
-import json
+from typing import Iterator, Optional, Tuple
+from multiprocessing import Pool
+
+import orjson
 
 import tqdm
 import logging
 
 import re
-import bs4
-import trafilatura
+import lxml.html
+import lxml.etree
 
 
 logging.basicConfig(filename='log/extract-item1a-full.log', 
@@ -18,64 +22,102 @@ logging.basicConfig(filename='log/extract-item1a-full.log',
                     level=logging.WARNING)
 
 
-def extract_item1a(f: str) -> str:
+# Find the html section (throw away metadata); matched against the raw
+#   (memory-mapped) bytes of the filing
+PATTERN_HTML = re.compile(rb'<html.*?>(.*?)</html>', flags=(re.DOTALL | re.IGNORECASE))
 
-    # Find the html section (throw away metadata)
-    pattern_html = re.compile(r'<html.*?>(.*?)</html>', flags=(re.DOTALL | re.IGNORECASE))
-    with open(f, 'r', encoding='utf8') as fin:
-        matched_html = pattern_html.search(fin.read())
+# Find starting tag and ending tag for section Item 1A
+PATTERNS_START = [
+    r"^item 1a ?risk factors$",
 
-        # Use bs4 to parse (fix) html
-        if matched_html is None:
-            logging.error(f'Corrupted format: Empty content between <html>(.*)</html>, < {f} >')
-            raise Exception('Corrupted format: Empty content between <html>(.*)</html>')
-        soup = bs4.BeautifulSoup(matched_html.group(1), features='html5lib')
+    # NEM edge cases
+    r"^item 1a ?risk factors \(.*?\)$"
+]
+PATTERNS_END = [
+    r"^item 1b ?unresolved staff comments$", 
+    r"^item 2 ?properties$",
     
-    # Find starting tag and ending tag for section Item 1A
-    patterns_start = [
-        r"^item 1a ?risk factors$",
-
-        # NEM edge cases
-        r"^item 1a ?risk factors \(.*?\)$"
-    ]
-    patterns_end = [
-        r"^item 1b ?unresolved staff comments$", 
-        r"^item 2 ?properties$",
-        
-        # NEM edge cases
-        r"^item 2 ?properties \(.*?\)$",
+    # NEM edge cases
+    r"^item 2 ?properties \(.*?\)$",
+
+    # LODE edge cases
+    r"^item 2 description of properties$"
+]
+
+# Start and end patterns are mutually exclusive, so match both in a single pass
+#   and tell them apart by the name of the group that matched
+PATTERN_ITEM = re.compile(fr"(?P<start>{'|'.join(PATTERNS_START)})|(?P<end>{'|'.join(PATTERNS_END)})",
+                          flags=(re.IGNORECASE | re.DOTALL))
 
-        # LODE edge cases
-        r"^item 2 description of properties$"
-    ]
+# Both start and end patterns begin with <item 1> or <item 2> after cleaning;
+#   used to cheaply reject (almost all) tags on their raw text
+PATTERN_ITEM_PREFIX = re.compile(r'[\s.:,;]*item[\s.:,;]*[12]', flags=re.IGNORECASE)
 
-    patterns_start = re.compile(r'|'.join(patterns_start), flags=(re.IGNORECASE | re.DOTALL))
-    patterns_end = re.compile(r'|'.join(patterns_end), flags=(re.IGNORECASE | re.DOTALL))
+# Text cleaning and post processing
+PUNCT_RE = re.compile(r'[.:,;]')
+WS_RE = re.compile(r'\s+')
+PAGE_NUM_RE = re.compile(r'\n[0-9]{1,2}\n')
+
+# A line break and the first character of the following line
+PARA_MERGE_RE = re.compile(r'\n(?=(.))', flags=re.DOTALL)
+
+# Tags rendered on lines of their own when converting html to text
+BLOCK_TAGS = ('p', 'div', 'br', 'tr', 'li', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6')
+
+
+def extract_item1a(f: str) -> str:
 
+    # Search the memory-mapped file so only the html section gets copied and decoded
+    with open(f, 'rb') as fin:
+
+        # Empty files cannot be memory-mapped
+        if os.fstat(fin.fileno()).st_size == 0:
+            logging.error(f'Corrupted format: Empty file, < {f} >')
+            raise Exception('Corrupted format: Empty file')
+
+        with mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            matched_html = PATTERN_HTML.search(buf)
+
+            # Use lxml to parse (fix) html
+            if matched_html is None:
+                logging.error(f'Corrupted format: Empty content between <html>(.*)</html>, < {f} >')
+                raise Exception('Corrupted format: Empty content between <html>(.*)</html>')
+            try:
+                root = lxml.html.document_fromstring(matched_html.group(1).decode('utf8', errors='replace'))
+            except lxml.etree.ParserError:
+                logging.error(f'Corrupted format: Unparsable html, < {f} >')
+                raise Exception('Corrupted format: Unparsable html')
+
+    # Find starting tag and ending tag for section Item 1A
     index_start = index_end = -1
     tag_start = tag_end = None
 
-    # Iterate through all fonts BACKWARD (to skip table of contents)
-    for i, tag in enumerate((list(soup.find_all('font'))
-                                + list(soup.find_all('b'))
-                                + list(soup.find_all('p'))
-                                + list(soup.find_all('div'))
-                                + list(soup.find_all('table')))[::-1]):
+    # Iterate through all candidate tags BACKWARD (to skip table of contents),
+    #   collected in a single document-order traversal
+    for i, tag in enumerate(reversed(list(root.iter('font', 'b', 'p', 'div', 'table')))):
+        s = tag.text_content()
+        if PATTERN_ITEM_PREFIX.match(s) is None:
+            continue
+
         # Clean text
-        s = re.sub(r'[.:,;]', '', ''.join(tag.strings))
-        s = re.sub(r'\s+', ' ', s).strip()
+        s = PUNCT_RE.sub('', s)
+        s = WS_RE.sub(' ', s).strip()
+
+        matched_item = PATTERN_ITEM.match(s)
+        if matched_item is None:
+            continue
 
         # Start tag
-        if patterns_start.match(s) is not None:
+        if matched_item.lastgroup == 'start':
             index_start = i
             tag_start = tag
 
         # End tag
-        if patterns_end.match(s) is not None:
+        if matched_item.lastgroup == 'end':
             index_end = i
             tag_end = tag
         
-        if tag_start and tag_end:
+        if tag_start is not None and tag_end is not None:
             break
 
     if index_start <= index_end:
@@ -83,10 +125,56 @@ def extract_item1a(f: str) -> str:
     assert tag_start is not None
     assert tag_end is not None
 
-    # Extract the Item 1A section html and extract texts
-    item1a_pattern = f'{re.escape(str(tag_start))}(.*?){re.escape(str(tag_end))}'  # EXACT MATCHING, NO SPECIAL CHAR
-    item1a_html = re.compile(item1a_pattern, flags=re.DOTALL).search(str(soup)).group(1)
-    item1a_text = trafilatura.extract(item1a_html, favor_precision=True, include_tables=False)
+    # The section lies within the closest common ancestor of both tags, in
+    #   its children from the one holding the start tag onward
+    ancestors_end = set(tag_end.iterancestors())
+    head = tag_start
+    while head.getparent() not in ancestors_end:
+        head = head.getparent()
+
+    # Walk the tree from the end of the start tag up to the end tag, skipping
+    #   tables and putting each block tag on a line of its own
+    def _to_text() -> Optional[str]:
+
+        # Sibling comments (or processing instructions) cannot be walked, but
+        #   they are leaves anyway
+        events = itertools.chain.from_iterable(
+            lxml.etree.iterwalk(e, events=('start', 'end', 'comment', 'pi')) if isinstance(e.tag, str)
+                else [('comment', e)]
+            for e in itertools.chain([head], head.itersiblings()))
+
+        parts = []
+        inside, tables = False, 0
+        for event, node in events:
+            if node is tag_end:
+                return ''.join(parts) if inside else None
+            if not inside:
+                inside = node is tag_start and event == 'end'
+                if inside:
+                    parts.append(node.tail or '')
+                continue
+
+            sep = '\n' if node.tag in BLOCK_TAGS else ''
+            if event == 'start':
+                if node.tag == 'table':
+                    tables += 1
+                if tables == 0:
+                    parts.append(sep + (node.text or ''))
+            else:
+                # Tables closing around the start tag were never opened here
+                if event == 'end' and node.tag == 'table' and tables > 0:
+                    tables -= 1
+                if tables == 0:
+                    parts.append(sep + (node.tail or ''))
+        return None
+
+    item1a_text = _to_text()
+    if item1a_text is None:
+        logging.error(f'Failed to locate Item 1A section: < {f} >')
+        raise Exception('Failed to locate Item 1A section')
+
+    lines = (WS_RE.sub(' ', line).strip() for line in item1a_text.split('\n'))
+    item1a_text = '\n'.join(line for line in lines if line)
 
     # Post processing
     #   - Remove page numbers
@@ -94,19 +182,17 @@ def extract_item1a(f: str) -> str:
     def _post_process(s: str) -> str:
 
         # Page numbers are of <\n[0-9]{1}{2}\n> pattern
-        s = re.sub(r'\n[0-9]{1,2}\n', r' ', s)
+        s = PAGE_NUM_RE.sub(' ', s)
 
-        # Merge paragraphs with lower-case starting to
+        # Merge paragraphs with lower-case (or non-letter) starting to
         #   the proceeding paragraph
-        r = ['']
-        for p in s.split('\n'):
-            if ((p[0].isalpha() and p[0].islower()) 
-                    or p[0].isnumeric()
-                    or not p[0].isalnum()):  
-                r[-1] = f'{r[-1]} {p}'.strip()
-            else:
-                r.append(p)
-        return '\n'.join(r).strip()
+        def _merge(m: re.Match) -> str:
+            c = m.group(1)
+            if (c.isalpha() and c.islower()) or c.isnumeric() or not c.isalnum():
+                return ' '
+            return '\n'
+
+        return PARA_MERGE_RE.sub(_merge, s).strip()
 
     ret = _post_process(item1a_text)
     if len(ret) < 32:
@@ -114,43 +200,64 @@ def extract_item1a(f: str) -> str:
     return ret
 
 
+def safe_extract(f: str) -> Tuple[str, str, int]:
+    """Extract Item 1A from the filing, return (path, text, status)"""
+
+    try:
+        return f, extract_item1a(f), 0
+    except Exception:
+        logging.error(f'Unknown error: < {f} >')
+        return f, f'<FAILED>{f}</FAILED>', 1
+
+
+def iter_filings(root: str = 'data/filings') -> Iterator[Tuple[str, str, str]]:
+    """Enumerate raw 10-K filings laid out as <root>/<cik>/10-K/<yyyymmdd>/, yield (cik, yyyy-mm, path)"""
+
+    for cik in sorted(os.scandir(root), key=lambda e: e.name):
+        dform = os.path.join(cik.path, '10-K')
+        if not os.path.isdir(dform):
+            continue
+
+        for filed in sorted(os.scandir(dform), key=lambda e: e.name):
+
+            # Use annual 10-K forms after 2005 since Item 1A is not
+            #   required before then.
+            yyyymm = filed.name[:6]
+            if not (filed.name.isdigit() and len(filed.name) > 6 and 200601 <= int(yyyymm) <= 202912):
+                continue
+
+            f = os.path.join(filed.path, '__RAW__.htm')
+            if os.path.isfile(f):
+                yield cik.name, f'{yyyymm[:4]}-{yyyymm[4:]}', f
+
+
 # %%
 if __name__ == '__main__':
 
-    # Use annual 10-K forms after 2005 since Item 1A is not 
-    #   required before then.
-    fs = sorted([f for f in glob.glob(r'data/filings/*/10-K/*/__RAW__.htm') 
-                    if re.search(r'/20(0[6-9]|[1-2]\d)\d+/', f)])
-    
-    # Extract file date (yyyy-mm) and company names (symbols) from paths
-    ts = [f'{s.group(1)}-{s.group(2)}' for s in [re.search(r'/(20\d\d)(\d\d)\d+/', f) for f in fs]]
-    cs = [re.findall(r'filings/(.*?)/10-K', f)[0] for f in fs]
-
-    # Try extract Item 1A
+    # The list of filings is small, so collect it up front; company names
+    #   (symbols) and file dates (yyyy-mm) come with the paths. Output is
+    #   columnar, i.e., {column: [values]} that loads directly with
+    #   pd.DataFrame; the (large) Item 1A texts are written out as soon as
+    #   they arrive, only the small columns are held in memory and written after.
+    filings = list(iter_filings())
+    cs = [c for c, _, _ in filings]
+    ts = [t for _, t, _ in filings]
     status = []
-    item1a = []
 
     print('[ info ] :: start extraction...')
-    for f in tqdm.tqdm(fs):
-        try:
-            item1a.append(extract_item1a(f))
-            status.append(0)
-        except:
-            logging.error(f'Unknown error: < {f} >')
-            item1a.append(f'<FAILED>{f}</FAILED>')
-            status.append(1)
-    print('[ info ] :: DONE!')
+    with Pool(os.cpu_count()) as p, open('data/extracts/item1a-full.json', 'wb') as fout:
+        fout.write(b'{"item1a": [\n')
+        fs = (f for *_, f in filings)
+        for n, (_, i, s) in enumerate(tqdm.tqdm(p.imap(safe_extract, fs, chunksize=16), total=len(filings))):
+            status.append(s)
 
-    # Convert to DataFrame and write to CSV
-    outputs = []
-    for c, t, i, s in zip(cs, ts, item1a, status):
-        outputs.append({'symbol': c, 
-                        'filing_time': t, 
-                        'item1a': i, 
-                        'status': s})
-    
-    print('[ info ] :: dump to json file... ')
-    with open('data/extracts/item1a-full.json', 'w') as fout:
-        json.dump(outputs, fout, indent=True)
+            if n > 0:
+                fout.write(b',\n')
+            fout.write(orjson.dumps(i))
+        fout.write(b'\n]')
+
+        for k, v in (('symbol', cs), ('filing_time', ts), ('status', status)):
+            fout.write(b',\n' + orjson.dumps(k) + b': ' + orjson.dumps(v))
+        fout.write(b'\n}\n')
     print('[ info ] :: DONE!')
     print('[ info ] :: please find logging from <extract-item1a-full.log> for failed cases')